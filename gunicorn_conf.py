@@ -0,0 +1,14 @@
+# Gunicorn settings for running the app in production:
+#   gunicorn -c gunicorn_conf.py main:app
+# Background task results (/api/tasks/<id>), the Gemini cache, in-flight
+# request coalescing and the sheet write batch all live in process memory.
+# With more than one worker, a poll could land on a process that never saw
+# the task (404), so run a single process and scale with threads instead.
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5001')}"
+workers = 1
+threads = 32
+worker_class = 'gthread'
+keepalive = 75
+timeout = 120
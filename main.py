@@ -1,19 +1,84 @@
 import os
-import json
-import requests
-import base64
+import asyncio
+import orjson
+import fastjsonschema
+import atexit
+import functools
+import hashlib
+import io
+import logging
+import logging.handlers
+import operator
+import queue
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 from flask import Flask, request, jsonify
 from flask_cors import CORS
-from telegram import Bot, Update
-from telegram.ext import Dispatcher, MessageHandler, Filters # Make sure this line is uncommented
-from google.oauth2 import service_account
-import gspread
-from google.genai import types
-from google import genai
-from typing import Dict, Tuple, Optional, Any
+from werkzeug.middleware.proxy_fix import ProxyFix
+from typing import TYPE_CHECKING, Dict, Tuple, Optional, Any, Union
+
+# google-genai, gspread, telegram and Pillow are imported where they are first
+# used, so the app (and /healthz) can start without loading them.
+if TYPE_CHECKING:
+    from telegram import Update
+
+# --- Logging ---
+# Records are handed to a queue and written to stderr by a listener thread, so
+# request workers never block on console I/O.
+_log_queue: queue.SimpleQueue = queue.SimpleQueue()
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+_log_level = logging.getLevelName(LOG_LEVEL) # An int for known names, else a "Level ..." string
+logging.basicConfig(
+    level=_log_level if isinstance(_log_level, int) else logging.INFO,
+    format="%(asctime)s %(levelname)s %(name)s: %(message)s",
+    handlers=[logging.handlers.QueueHandler(_log_queue)],
+)
+_log_listener = logging.handlers.QueueListener(_log_queue, logging.StreamHandler())
+_log_listener.start()
+atexit.register(_log_listener.stop)
+logger = logging.getLogger(__name__)
+if not isinstance(_log_level, int):
+    logger.warning("Unknown LOG_LEVEL %r, using INFO.", LOG_LEVEL)
 
 app = Flask(__name__)
 CORS(app)  # Enable CORS for all routes
+# Trust one reverse proxy's X-Forwarded-* headers (e.g. Render, nginx)
+app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1, x_proto=1, x_host=1)
+
+# Reject oversized request bodies before they are parsed
+MAX_UPLOAD_BYTES = 20 * 1024 * 1024
+app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_BYTES
+
+@app.errorhandler(413)
+def request_too_large(e):
+    """Returns the API's JSON error shape instead of Werkzeug's HTML 413 page."""
+    return jsonify({"error": "Image file too large", "max_bytes": MAX_UPLOAD_BYTES}), 413
+
+# Gemini + Sheets work runs here so request threads can return immediately
+EXECUTOR_WORKERS = 8
+EXECUTOR = ThreadPoolExecutor(max_workers=EXECUTOR_WORKERS)
+
+# Background API tasks, keyed by task id, oldest first. Finished tasks are
+# kept for TASK_RETENTION seconds after submission so clients can poll them.
+TASK_RETENTION = 600.0
+_tasks: "OrderedDict[str, Tuple[Future, float]]" = OrderedDict() # task id -> (future, submitted at)
+_tasks_lock = threading.Lock()
+
+def _submit_task(*args) -> str:
+    """Submits work to EXECUTOR and returns its task id, expiring old finished tasks."""
+    task_id = uuid.uuid4().hex
+    now = time.monotonic()
+    with _tasks_lock:
+        for old_id, (future, submitted_at) in list(_tasks.items()):
+            if now - submitted_at <= TASK_RETENTION:
+                break
+            if future.done():
+                del _tasks[old_id]
+        _tasks[task_id] = (EXECUTOR.submit(*args), now)
+    return task_id
 
 # --- Environment Variable Checks (Optional but Recommended) ---
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
@@ -21,132 +86,495 @@ TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
 
 if not GEMINI_API_KEY:
-    print("Warning: GEMINI_API_KEY environment variable not set.")
+    logger.warning("GEMINI_API_KEY environment variable not set.")
 # Add similar checks for TELEGRAM_BOT_TOKEN if that functionality is active
 
+FIXED_PROMPT = """Extract the total amount, date, and platform from this transaction image. If available, also extract items purchased and the vendor name.
+    Return a JSON object in the following format:
+    {
+        "Amount": "Total amount",
+        "Date": "Date of transaction",
+        "Platform": "Platform used",
+        "Items": "Items purchased",
+        "Vendor": "Vendor name"
+    }"""
+
+# Shape expected back from Gemini; compiled to a validator once at import and
+# also sent to Gemini (see _gemini_config) so its output is constrained to it
+TRANSACTION_SCHEMA = {
+    "type": "object",
+    "required": ["Amount", "Date", "Platform"],
+    "properties": {
+        "Amount": {"type": "string"},
+        "Date": {"type": "string"},
+        "Platform": {"type": "string"},
+        "Items": {"type": ["string", "null"]},
+        "Vendor": {"type": ["string", "null"]},
+    },
+}
+_validate_transaction = fastjsonschema.compile(TRANSACTION_SCHEMA)
+
 # --- Client Initializations ---
-try:
-    GeminiClient = genai.Client(api_key=GEMINI_API_KEY)
-except Exception as e:
-    print(f"Error initializing Gemini Client: {e}")
-    GeminiClient = None # Handle cases where client might not initialize
-
-# Initialize Bot (ensure this is uncommented and TELEGRAM_BOT_TOKEN is set)
-if TELEGRAM_BOT_TOKEN:
-    bot = Bot(token=TELEGRAM_BOT_TOKEN)
-else:
-    bot = None
-    print("Warning: TELEGRAM_BOT_TOKEN not set. Telegram bot functionality will be disabled.")
+# Each client is created on first use; None means it could not be initialized.
+def _memoize_client(getter):
+    """Caches a client getter's first non-None result.
+
+    A failed initialization is retried on the next call instead of disabling
+    the client for the life of the process, and a lock keeps concurrent first
+    calls from building duplicate clients.
+    """
+    lock = threading.Lock()
+    client = None
+
+    @functools.wraps(getter)
+    def wrapper():
+        nonlocal client
+        if client is None:
+            with lock:
+                if client is None:
+                    client = getter()
+        return client
+    return wrapper
+
+@_memoize_client
+def _get_gemini():
+    """Returns the Gemini client, or None if it could not be initialized."""
+    try:
+        from google import genai
+        return genai.Client(api_key=GEMINI_API_KEY)
+    except Exception as e:
+        logger.error("Error initializing Gemini Client: %s", e)
+        return None # Handle cases where client might not initialize
+
+@functools.cache
+def _gemini_config():
+    """Asks Gemini for a bare JSON body matching TRANSACTION_SCHEMA."""
+    from google.genai import types
+    # Gemini's schema dialect marks optional values as nullable rather than
+    # using JSON Schema type lists; every field here is a string.
+    properties = {
+        name: types.Schema(
+            type=types.Type.STRING,
+            nullable=isinstance(prop["type"], list) and "null" in prop["type"],
+        )
+        for name, prop in TRANSACTION_SCHEMA["properties"].items()
+    }
+    return types.GenerateContentConfig(
+        response_mime_type='application/json',
+        response_schema=types.Schema(
+            type=types.Type.OBJECT,
+            properties=properties,
+            required=TRANSACTION_SCHEMA["required"],
+        ),
+    )
+
+# Gemini calls go through the SDK's async client on one background event loop,
+# so concurrent requests share its connections instead of each worker thread
+# blocking on its own.
+_gemini_loop = asyncio.new_event_loop()
+threading.Thread(target=_gemini_loop.run_forever, name="gemini-loop", daemon=True).start()
+
+GEMINI_TIMEOUT = 60.0 # Seconds before a single Gemini API call is abandoned
+
+def _run_on_gemini_loop(coro):
+    """Runs a Gemini SDK coroutine on the Gemini event loop and waits for it.
+
+    Raises FutureTimeoutError (and cancels the coroutine) if it
+    takes longer than GEMINI_TIMEOUT.
+    """
+    future = asyncio.run_coroutine_threadsafe(coro, _gemini_loop)
+    try:
+        return future.result(timeout=GEMINI_TIMEOUT)
+    except FutureTimeoutError:
+        future.cancel()
+        raise FutureTimeoutError(
+            f"Gemini call {getattr(coro, '__qualname__', coro)} did not finish within GEMINI_TIMEOUT ({GEMINI_TIMEOUT}s)"
+        ) from None
+
+def _generate_content(**kwargs):
+    """Runs the Gemini client's aio.models.generate_content on the Gemini event loop."""
+    return _run_on_gemini_loop(_get_gemini().aio.models.generate_content(**kwargs))
+
+# Inline image parts are base64-encoded into the JSON request body. Anything
+# bigger than this is sent once as raw bytes through the Files API instead.
+# After _shrink_image a decodable photo is well under this, so in practice
+# only data Pillow couldn't decode (passed through unchanged) takes that path.
+INLINE_IMAGE_MAX = 1024 * 1024
+
+def _image_part(image_data: Union[bytes, bytearray, memoryview]):
+    """Returns the Gemini content part for an image and the uploaded file name.
+
+    The name is None for inline parts; otherwise the caller must delete the
+    uploaded file once it is no longer needed.
+    """
+    from google.genai import types
+    if len(image_data) <= INLINE_IMAGE_MAX:
+        return types.Part.from_bytes(
+            data=image_data,
+            mime_type='image/jpeg', # Assuming JPEG, adjust if necessary
+        ), None
+    uploaded = _run_on_gemini_loop(_get_gemini().aio.files.upload(
+        file=io.BytesIO(image_data),
+        config=types.UploadFileConfig(mime_type='image/jpeg'),
+    ))
+    return types.Part.from_uri(file_uri=uploaded.uri, mime_type=uploaded.mime_type), uploaded.name
+
+def _analyze_image(image_data: Union[bytes, bytearray, memoryview]):
+    """Sends an image and FIXED_PROMPT to Gemini and returns the response."""
+    image_part, uploaded_name = _image_part(image_data)
+    try:
+        return _generate_content(
+            model='gemini-2.0-flash', # Consider making model configurable
+            contents=[image_part, FIXED_PROMPT],
+            config=_gemini_config()
+        )
+    finally:
+        if uploaded_name:
+            # Uploaded files count against the Files API quota until deleted
+            try:
+                _run_on_gemini_loop(_get_gemini().aio.files.delete(name=uploaded_name))
+            except Exception as e:
+                logger.warning("Error deleting uploaded Gemini file %s: %s", uploaded_name, e)
+
+# Initialize Bot (ensure TELEGRAM_BOT_TOKEN is set)
+# Every executor worker may be talking to Telegram at once (get_file plus the
+# download), so the bot's connection pool is sized to match and each worker
+# reuses a kept-alive connection.
+TELEGRAM_POOL_SIZE = EXECUTOR_WORKERS + 4
+
+@_memoize_client
+def _get_bot():
+    """Returns the Telegram bot, or None if it could not be initialized."""
+    if not TELEGRAM_BOT_TOKEN:
+        logger.warning("TELEGRAM_BOT_TOKEN not set. Telegram bot functionality will be disabled.")
+        return None
+    try:
+        from telegram import Bot
+        from telegram.utils.request import Request
+        return Bot(token=TELEGRAM_BOT_TOKEN, request=Request(con_pool_size=TELEGRAM_POOL_SIZE))
+    except Exception as e:
+        logger.error("Error initializing Telegram bot: %s", e)
+        return None
 
 # Google Sheets setup
 SCOPES = ['https://www.googleapis.com/auth/spreadsheets']
 SERVICE_ACCOUNT_FILE = 'google-creds.json'
 SPREADSHEET_ID = '103kvUS9DPTsZB0bB5n7eI7XKm5ckvooGykx4IvpvkVI'
 
-try:
-    creds = service_account.Credentials.from_service_account_file(
-        SERVICE_ACCOUNT_FILE, scopes=SCOPES)
-    gspread_client = gspread.authorize(creds)
-    sheet = gspread_client.open_by_key(SPREADSHEET_ID).sheet1
-except Exception as e:
-    print(f"Error initializing Google Sheets client: {e}")
-    sheet = None # Handle cases where sheet might not initialize
+@_memoize_client
+def _get_sheet():
+    """Returns the worksheet rows are logged to, or None if it could not be opened."""
+    try:
+        import gspread
+        from google.oauth2 import service_account
+        from google.auth.transport.requests import AuthorizedSession
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+        creds = service_account.Credentials.from_service_account_file(
+            SERVICE_ACCOUNT_FILE, scopes=SCOPES)
+        # One pooled keep-alive session for all Sheets calls instead of a new TLS
+        # connection per request. Retry's default allowed_methods exclude POST, so
+        # appends are never retried (and duplicated).
+        sheets_session = AuthorizedSession(creds)
+        sheets_session.mount('https://', HTTPAdapter(
+            pool_connections=4,
+            pool_maxsize=32,
+            max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504]),
+        ))
+        gspread_client = gspread.Client(auth=creds, session=sheets_session)
+        return gspread_client.open_by_key(SPREADSHEET_ID).sheet1
+    except Exception as e:
+        logger.error("Error initializing Google Sheets client: %s", e)
+        return None # Handle cases where sheet might not initialize
+
+# --- Batched Sheet Writes ---
+# Rows are buffered and written with a single append_rows call instead of one
+# append_row round-trip per transaction.
+BATCH_MAX = 20  # Flush as soon as this many rows are pending
+BATCH_INTERVAL = 5.0  # Seconds to wait before flushing a partial batch
+FLUSH_MAX_ATTEMPTS = 5  # Failed writes before a row is dropped (and logged)
+
+_pending_rows: deque = deque() # (row, failed attempts so far)
+_pending_lock = threading.Lock()
+_sheet_lock = threading.Lock() # Serializes writes from concurrent workers
+_flush_timer: Optional[threading.Timer] = None
+
+def _arm_flush_timer() -> None:
+    """Schedules a flush in BATCH_INTERVAL seconds. Caller holds _pending_lock."""
+    global _flush_timer
+    if _flush_timer is None:
+        _flush_timer = threading.Timer(BATCH_INTERVAL, _flush)
+        _flush_timer.daemon = True
+        _flush_timer.start()
 
-def process_and_log_transaction(image_data: bytes, user_note: str) -> Tuple[Optional[Dict[str, Any]], bool]:
+def _flush(final: bool = False) -> None:
+    """Writes all pending rows to the Google Sheet in one API call.
+
+    On failure the rows go back to the front of the queue and are retried
+    after BATCH_INTERVAL, up to FLUSH_MAX_ATTEMPTS times each. With final=True
+    (shutdown) there is no later attempt, so failed rows are dropped at once.
+    """
+    global _flush_timer
+    with _pending_lock:
+        if _flush_timer is not None:
+            _flush_timer.cancel()
+            _flush_timer = None
+        entries = list(_pending_rows)
+        _pending_rows.clear()
+
+    if not entries:
+        return
+    rows = [row for row, _ in entries]
+    try:
+        sheet = _get_sheet()
+        if not sheet:
+            raise RuntimeError("Google Sheets client not initialized")
+        with _sheet_lock:
+            # table_range names A1 as the anchor of the table the rows are appended to
+            sheet.append_rows(rows, value_input_option='RAW', insert_data_option='INSERT_ROWS', table_range='A1')
+    except Exception as e:
+        logger.error("Error writing %d row(s) to Google Sheets: %s", len(rows), e)
+        retry = [] if final else [(row, attempts + 1) for row, attempts in entries if attempts + 1 < FLUSH_MAX_ATTEMPTS]
+        dropped = [row for row, attempts in entries if final or attempts + 1 >= FLUSH_MAX_ATTEMPTS]
+        if dropped:
+            logger.error("Dropping %d row(s) that could not be written to Google Sheets: %s", len(dropped), dropped)
+        if retry:
+            with _pending_lock:
+                _pending_rows.extendleft(reversed(retry)) # Keep original order ahead of newer rows
+                _arm_flush_timer()
+
+def _enqueue_row(row: list) -> None:
+    """Queues a row for the next batched Google Sheets write."""
+    with _pending_lock:
+        _pending_rows.append((row, 0))
+        flush_now = len(_pending_rows) >= BATCH_MAX
+        if not flush_now:
+            _arm_flush_timer()
+    if flush_now:
+        _flush()
+
+atexit.register(_flush, final=True) # Don't lose buffered rows on shutdown
+
+# --- Gemini Response Cache ---
+# Parsed Gemini output keyed by a hash of the image bytes, so a resubmitted
+# receipt is logged again without paying for another Gemini call.
+GEMINI_CACHE_MAX = 256
+
+_gemini_cache: "OrderedDict[str, Tuple[Dict[str, Any], str]]" = OrderedDict()
+_gemini_cache_lock = threading.Lock()
+
+def _image_key(image_data: Union[bytes, bytearray, memoryview]) -> str:
+    """Returns the cache key for an image's content."""
+    return hashlib.blake2b(image_data, digest_size=16).hexdigest()
+
+def _cache_get(key: str) -> Optional[Tuple[Dict[str, Any], str]]:
+    """Returns the cached (analysis, raw response text) for key, if any."""
+    with _gemini_cache_lock:
+        entry = _gemini_cache.get(key)
+        if entry is not None:
+            _gemini_cache.move_to_end(key)
+        return entry
+
+def _cache_put(key: str, analysis: Dict[str, Any], raw_text: str) -> None:
+    """Stores a parsed Gemini response, evicting the least recently used entry."""
+    with _gemini_cache_lock:
+        _gemini_cache[key] = (dict(analysis), raw_text)
+        _gemini_cache.move_to_end(key)
+        while len(_gemini_cache) > GEMINI_CACHE_MAX:
+            _gemini_cache.popitem(last=False)
+
+# --- In-flight Request Coalescing ---
+# Only one worker calls Gemini for a given image at a time; others submitting
+# the same image wait for it and then read its result from the cache.
+_inflight: Dict[str, threading.Event] = {}
+_inflight_lock = threading.Lock()
+# An owner makes at most three bounded Gemini calls (upload, generate, delete)
+INFLIGHT_WAIT_TIMEOUT = 3 * GEMINI_TIMEOUT
+
+def _claim_or_cached(key: str) -> Optional[Tuple[Dict[str, Any], str]]:
+    """Returns the cached entry for key, or None once this caller owns the Gemini call.
+
+    Blocks while another worker is processing the same image, raising
+    TimeoutError if that takes longer than INFLIGHT_WAIT_TIMEOUT. An owner
+    must call _release_inflight(key) when done, whether or not it succeeded.
+    """
+    while True:
+        with _inflight_lock:
+            cached = _cache_get(key) # Checked under the lock so a just-finished owner isn't missed
+            if cached is not None:
+                return cached
+            event = _inflight.get(key)
+            if event is None:
+                _inflight[key] = threading.Event()
+                return None
+        if not event.wait(INFLIGHT_WAIT_TIMEOUT):
+            raise TimeoutError(f"Timed out waiting for the in-flight Gemini call for image {key}")
+        # The owner may have failed without caching anything; loop and retry
+
+def _release_inflight(key: str) -> None:
+    """Wakes any workers waiting on the Gemini call for key."""
+    with _inflight_lock:
+        event = _inflight.pop(key, None)
+    if event is not None:
+        event.set()
+
+# --- Image Preprocessing ---
+# Receipt extraction doesn't benefit from more than ~1024px on the long edge,
+# and Gemini's vision token count grows with image area.
+IMAGE_MAX_SIDE = 1024
+IMAGE_JPEG_QUALITY = 85
+
+@functools.cache
+def _pillow():
+    """Returns (Image, ImageOps), or None if Pillow is not installed (logged once)."""
+    try:
+        from PIL import Image, ImageOps
+        return Image, ImageOps
+    except ImportError as e:
+        logger.warning("Pillow not available, images are sent without shrinking: %s", e)
+        return None
+
+def _shrink_image(image_data: Union[bytes, bytearray, memoryview]) -> Union[bytes, bytearray, memoryview]:
+    """Downscales an image to IMAGE_MAX_SIDE and re-encodes it as JPEG.
+
+    Returns the original data unchanged if it is already small enough,
+    cannot be decoded, or Pillow is not installed.
+    """
+    pillow = _pillow()
+    if pillow is None:
+        return image_data
+    Image, ImageOps = pillow
+    try:
+        im = Image.open(io.BytesIO(image_data))
+        if max(im.size) <= IMAGE_MAX_SIDE and im.format == 'JPEG':
+            return image_data
+        # Re-encoding drops EXIF, so apply its orientation to the pixels first
+        im = ImageOps.exif_transpose(im)
+        im.thumbnail((IMAGE_MAX_SIDE, IMAGE_MAX_SIDE), Image.LANCZOS)
+        out = io.BytesIO()
+        im.convert('RGB').save(out, 'JPEG', quality=IMAGE_JPEG_QUALITY, optimize=True)
+        return out.getvalue()
+    except Exception as e:
+        logger.warning("Could not shrink image, sending original: %s", e)
+        return image_data
+
+# --- Raw Response Storage ---
+# Raw Gemini output is kept on disk and only its id goes into the sheet, so
+# rows stay small as the sheet grows.
+RAW_LOG_DIR = os.getenv("RAW_LOG_DIR", "raw_logs")
+
+def _store_raw_response(raw_text: str) -> str:
+    """Writes raw Gemini output to RAW_LOG_DIR and returns its id."""
+    raw_bytes = raw_text.encode()
+    raw_id = hashlib.blake2b(raw_bytes, digest_size=8).hexdigest()
+    path = os.path.join(RAW_LOG_DIR, f"{raw_id}.txt")
+    try:
+        if not os.path.exists(path): # Same text, same id: resubmits don't rewrite it
+            os.makedirs(RAW_LOG_DIR, exist_ok=True)
+            with open(path, 'wb') as f:
+                f.write(raw_bytes)
+    except OSError as e:
+        logger.error("Error writing raw Gemini response %s: %s", raw_id, e)
+    return raw_id
+
+# Sheet columns taken from the Gemini analysis, in order; missing ones are blank
+ROW_COLUMNS = ("Amount", "Date", "Platform", "Items", "Vendor")
+_row_getter = operator.itemgetter(*ROW_COLUMNS)
+_EMPTY_ROW = dict.fromkeys(ROW_COLUMNS, "")
+
+def _log_transaction_row(structured_analysis: Dict[str, Any], user_note: str, raw_text: str) -> None:
+    """Queues a processed transaction for the Google Sheet."""
+    # Ensure your Google Sheet has columns for: Amount, Date, Platform, Items, Vendor, Note, Raw Gemini Output ID
+    _enqueue_row([
+        *_row_getter({**_EMPTY_ROW, **structured_analysis}),
+        user_note,
+        _store_raw_response(raw_text) # Id of the raw Gemini output in RAW_LOG_DIR, for debugging/auditing
+    ])
+
+def process_and_log_transaction(image_data: Union[bytes, bytearray, memoryview], user_note: str) -> Tuple[Optional[Dict[str, Any]], bool]:
     """Processes transaction image and text using Gemini, then logs to Google Sheets.
 
     Args:
-        image_data: The byte content of the transaction image.
+        image_data: The byte content of the transaction image (any bytes-like object).
         user_note: A note provided by the user regarding the transaction.
 
     Returns:
         A tuple containing the processed data (dict) or an error message (dict), 
         and a boolean indicating success.
     """
-    if not GeminiClient:
+    if not _get_gemini():
         return {"error": "Gemini client not initialized"}, False
-    if not sheet:
+    if not _get_sheet():
         return {"error": "Google Sheets client not initialized"}, False
 
-    fixed_prompt = """Extract the total amount, date, and platform from this transaction image. If available, also extract items purchased and the vendor name.
-    Return the output in the following format:
-    ```json
-    {{
-        "Amount": "Total amount",
-        "Date": "Date of transaction",
-        "Platform": "Platform used",
-        "Items": "Items purchased",
-        "Vendor": "Vendor name"
-    }}
-    ```"""
+    image_key = _image_key(image_data)
+    try:
+        cached = _claim_or_cached(image_key)
+    except TimeoutError as e:
+        logger.error("%s", e)
+        return {"error": "Gemini API request timed out", "details": str(e)}, False
+    if cached is not None:
+        cached_analysis, cached_text = cached
+        structured_analysis = dict(cached_analysis)
+        structured_analysis['Note'] = user_note # Merge in the note from this submission
+        logger.info("Using cached Gemini response for image %s", image_key)
+        _log_transaction_row(structured_analysis, user_note, cached_text)
+        return structured_analysis, True
 
     try:
-        response = GeminiClient.models.generate_content(
-            model='gemini-2.0-flash', # Consider making model configurable
-            contents=[
-                types.Part.from_bytes(
-                    data=image_data,
-                    mime_type='image/jpeg', # Assuming JPEG, adjust if necessary
-                ),
-                fixed_prompt
-            ]
-        )
-        
-        cleaned_pre_analysis_text = response.text.strip()
-        # Attempt to extract JSON from the response text
-        json_start = cleaned_pre_analysis_text.find('{')
-        json_end = cleaned_pre_analysis_text.rfind('}')
+        response = _analyze_image(_shrink_image(image_data))
         
-        if json_start != -1 and json_end != -1 and json_start < json_end:
-            json_str = cleaned_pre_analysis_text[json_start:json_end+1]
-            try:
-                structured_analysis = json.loads(json_str)
-                structured_analysis['Note'] = user_note # Add user note to the data
-                print(f"Successfully parsed Gemini response: {json.dumps(structured_analysis, indent=2)}")
-
-                # Log to Google Sheet
-                # Ensure your Google Sheet has columns for: Amount, Date, Platform, Items, Vendor, Note, Raw Gemini Output
-                sheet.append_row([
-                    structured_analysis.get("Amount", ""),
-                    structured_analysis.get("Date", ""),
-                    structured_analysis.get("Platform", ""),
-                    structured_analysis.get("Items", ""),
-                    structured_analysis.get("Vendor", ""),
-                    user_note,
-                    response.text # Log the raw Gemini output for debugging/auditing
-                ])
-                return structured_analysis, True
-            except json.JSONDecodeError as e:
-                print(f"Failed to parse Gemini response as JSON: {e}")
-                print(f"Cleaned text provided for parsing: {json_str}")
-                print(f"Full response text: {response.text}")
-                return {"error": "Failed to parse Gemini JSON response", "details": str(e), "raw_response": response.text}, False
-        else:
-            print("Could not find JSON object in the Gemini response.")
-            print(f"Response text: {response.text}")
-            return {"error": "Could not find JSON in Gemini response", "raw_response": response.text}, False
+        _resp_text = response.text or "" # Property access; read it once
+        try:
+            structured_analysis = orjson.loads(_resp_text)
+        except orjson.JSONDecodeError as e:
+            logger.error("Failed to parse Gemini response as JSON: %s", e)
+            logger.debug("Full response text: %s", _resp_text)
+            return {"error": "Failed to parse Gemini JSON response", "details": str(e), "raw_response": _resp_text}, False
+
+        try:
+            _validate_transaction(structured_analysis)
+        except fastjsonschema.JsonSchemaValueException as e:
+            logger.error("Gemini response failed validation: %s", e.message)
+            logger.debug("Response text: %s", _resp_text)
+            return {"error": "Gemini response failed validation", "details": e.message, "raw_response": _resp_text}, False
+
+        _cache_put(image_key, structured_analysis, _resp_text)
+        structured_analysis['Note'] = user_note # Add user note to the data
+        logger.info("Successfully parsed Gemini response for image %s", image_key)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Parsed Gemini response: %s", orjson.dumps(structured_analysis, option=orjson.OPT_INDENT_2).decode())
+
+        # Log to Google Sheet
+        _log_transaction_row(structured_analysis, user_note, _resp_text)
+        return structured_analysis, True
 
+    except FutureTimeoutError as e:
+        logger.error("%s", e)
+        return {"error": "Gemini API request timed out", "details": str(e)}, False
     except Exception as e:
-        print(f"Error during Gemini API call or processing: {e}")
+        logger.error("Error during Gemini API call or processing: %s", e)
         return {"error": "Gemini API request failed", "details": str(e)}, False
+    finally:
+        _release_inflight(image_key)
 
 # Handle photo message (Telegram bot)
-def handle_image(update: Update, context):
+def handle_image(update: "Update", context):
     """Handles image messages sent to the Telegram bot."""
-    if not bot:
-        print("Telegram bot not initialized. Skipping handle_image.")
+    if not _get_bot():
+        logger.warning("Telegram bot not initialized. Skipping handle_image.")
         if update.message:
              update.message.reply_text("Telegram bot is currently unavailable.")
         return
 
     try:
-        # Get the largest photo and download its content
+        # Get the largest photo and download its content. This runs on an
+        # EXECUTOR worker (see webhook), not on the request thread.
         photo_file = update.message.photo[-1].get_file()
-        img_bytes = photo_file.download_as_bytearray()
-        img_data = bytes(img_bytes)
+        img_data = photo_file.download_as_bytearray() # Passed through as-is, no extra copy
 
     except Exception as e:
-        print(f"Error downloading image from Telegram: {e}")
+        logger.error("Error downloading image from Telegram: %s", e)
         update.message.reply_text("Sorry, I couldn't download the image.")
         return
     
@@ -181,11 +609,16 @@ def api_process_transaction():
         return jsonify({"error": "No selected file"}), 400
 
     try:
+        # Oversized bodies were already rejected by MAX_CONTENT_LENGTH
         image_bytes = image_file.read()
     except Exception as e:
-        print(f"Error reading image file: {e}")
+        logger.error("Error reading image file: %s", e)
         return jsonify({"error": "Could not read image file", "details": str(e)}), 400
 
+    if request.form.get('async') == '1':
+        task_id = _submit_task(process_and_log_transaction, image_bytes, user_note)
+        return jsonify({"message": "Transaction queued", "task_id": task_id}), 202
+
     processed_data, success = process_and_log_transaction(image_bytes, user_note)
 
     if success:
@@ -194,40 +627,83 @@ def api_process_transaction():
         # Ensure processed_data (which is an error dict here) is serializable
         return jsonify({"error": "Failed to process transaction", "details": processed_data}), 500
 
-# Setup dispatcher for Telegram (Uncomment these lines)
-if bot:
-    dispatcher = Dispatcher(bot, None, workers=0) # Consider adjusting workers based on load
-    # This handler will call `handle_image` when a photo message is received
-    dispatcher.add_handler(MessageHandler(Filters.photo, handle_image))
-else:
-    dispatcher = None
+@app.route("/api/tasks/<task_id>", methods=["GET"])
+def api_task_status(task_id: str):
+    """Returns the result of a transaction queued with async=1."""
+    with _tasks_lock:
+        entry = _tasks.get(task_id)
+    if entry is None:
+        return jsonify({"error": "Unknown task id"}), 404
+    future, _ = entry
+    if not future.done():
+        return jsonify({"status": "pending"}), 202
+
+    with _tasks_lock:
+        _tasks.pop(task_id, None)
+    try:
+        processed_data, success = future.result()
+    except Exception as e:
+        logger.error("Background task %s failed: %s", task_id, e)
+        processed_data, success = {"error": "Background task failed", "details": str(e)}, False
+
+    if success:
+        return jsonify({"status": "done", "message": "Transaction processed successfully", "data": processed_data}), 200
+    else:
+        return jsonify({"status": "failed", "error": "Failed to process transaction", "details": processed_data}), 500
+
+@app.route("/healthz", methods=["GET"])
+def healthz():
+    """Liveness check; doesn't touch Gemini, Sheets or Telegram."""
+    return jsonify({"status": "ok"}), 200
+
+# Setup dispatcher for Telegram
+@_memoize_client
+def _get_dispatcher():
+    """Returns the Telegram dispatcher, or None if the bot is not available."""
+    bot = _get_bot()
+    if not bot:
+        return None
+    try:
+        from telegram.ext import Dispatcher, MessageHandler, Filters
+        dispatcher = Dispatcher(bot, None, workers=0) # Consider adjusting workers based on load
+        # This handler will call `handle_image` when a photo message is received
+        dispatcher.add_handler(MessageHandler(Filters.photo, handle_image))
+        return dispatcher
+    except Exception as e:
+        logger.error("Error initializing Telegram dispatcher: %s", e)
+        return None
 
 # Webhook route for Telegram (Uncomment this section)
 @app.route(f"/{WEBHOOK_SECRET}", methods=["POST"])
 def webhook():
     """Webhook endpoint for Telegram to send updates."""
-    if not dispatcher or not WEBHOOK_SECRET:
-        print("Webhook not configured or dispatcher not available.")
+    dispatcher = _get_dispatcher() if WEBHOOK_SECRET else None
+    if not dispatcher:
+        logger.warning("Webhook not configured or dispatcher not available.")
         return "Webhook not configured", 500 # Or a 404 if you prefer to hide it
     
-    # Process the update from Telegram
-    update = Update.de_json(request.get_json(force=True), bot)
-    dispatcher.process_update(update)
+    # Process the update from Telegram in the background and ACK right away,
+    # otherwise Telegram retries while Gemini/Sheets are still working
+    from telegram import Update
+    update = Update.de_json(request.get_json(force=True), dispatcher.bot)
+    EXECUTOR.submit(dispatcher.process_update, update)
     return "ok", 200
 
 if __name__ == '__main__':
-    # For local development.
+    # For local development. In production run under gunicorn instead:
+    #   gunicorn -c gunicorn_conf.py main:app
     # Ensure GEMINI_API_KEY, (optionally TELEGRAM_BOT_TOKEN, WEBHOOK_SECRET) are set as environment variables.
     # And 'google-creds.json' is in the same directory.
     # For the webhook to work, your Flask app needs to be accessible from the internet.
     # You'll need to set the webhook URL with Telegram using their API.
     # Example (run this once, perhaps in a separate script or manually via curl after your app is deployed):
+    bot = _get_bot()
     if bot and WEBHOOK_SECRET:
         # Replace YOUR_PUBLIC_URL with the actual public URL of your app
         # e.g., https://your-app-name.onrender.com or your ngrok URL for testing
         webhook_url = f"https://8248-122-172-81-107.ngrok-free.app/{WEBHOOK_SECRET}"
         bot.set_webhook(webhook_url)
-        print(f"Telegram webhook set to: {webhook_url}")
+        logger.info("Telegram webhook set to: %s", webhook_url)
     
     app.run(debug=True, port=5001)
 